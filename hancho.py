@@ -5,15 +5,21 @@
 import argparse
 import asyncio
 import builtins
+import codecs
+import hashlib
+import importlib.util
 import inspect
 import io
 import json
+import marshal
 import os
 import re
+import shlex
 import subprocess
 import sys
 import traceback
 import types
+from collections import defaultdict
 from pathlib import Path
 from os.path import relpath
 from os.path import abspath
@@ -44,7 +50,17 @@ def color(red=None, green=None, blue=None):
 
 def is_atom(element):
     """Returns True if 'element' should _not_ be flattened out"""
-    return isinstance(element, str) or not hasattr(element, "__iter__")
+    # Fast paths for the common cases before the generic iterable check.
+    if isinstance(element, (list, tuple)):
+        return False
+    if isinstance(element, str):
+        return True
+    return not hasattr(element, "__iter__")
+
+
+def join_path(directory, filename):
+    """Joins and normalizes a directory and filename into a string path"""
+    return os.path.normpath(os.path.join(directory, str(filename)))
 
 
 def run_cmd(cmd):
@@ -64,9 +80,184 @@ def swap_ext(name, new_ext):
 
 
 def mtime(filename):
-    """Gets the file's mtime and tracks how many times we called it"""
-    this.mtime_calls += 1
-    return Path(filename).stat().st_mtime
+    """
+    Gets the file's mtime and tracks how many times we called it. Results are
+    cached for the duration of the build, tasks evict their outputs after they
+    run.
+    """
+    if not isinstance(filename, str):
+        filename = os.fspath(filename)
+    result = this.mtime_cache.get(filename)
+    if result is None:
+        this.mtime_calls += 1
+        result = os.stat(filename).st_mtime
+        this.mtime_cache[filename] = result
+    return result
+
+
+def scandir_mtimes(filenames):
+    """
+    Pre-populates the mtime cache for a batch of files by scanning each of
+    their parent directories once instead of stat()ing every file separately.
+    Files we can't find this way are left for mtime() to deal with.
+
+    Only worth it on Windows, where the directory scan returns stat data for
+    free. On POSIX DirEntry.stat() is a syscall of its own.
+    """
+    by_dir = defaultdict(dict)
+    for filename in filenames:
+        filename = str(filename)
+        if filename not in this.mtime_cache:
+            dirname, basename = os.path.split(filename)
+            by_dir[dirname or "."][basename] = filename
+
+    for dirname, names in by_dir.items():
+        # Not worth a directory scan for a single file
+        if len(names) < 2:
+            continue
+        try:
+            with os.scandir(dirname) as entries:
+                for entry in entries:
+                    if filename := names.get(entry.name):
+                        this.mtime_calls += 1
+                        this.mtime_cache[filename] = entry.stat().st_mtime
+        except OSError:
+            pass
+
+
+def hash_file(filename):
+    """Returns the blake2b hash of a file's contents as a hex string"""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as file:
+        while chunk := file.read(65536):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def cached_hash(filename, file_mtime, size):
+    """
+    Returns the hash of a file's contents, hashing it on a worker thread the
+    first time any task asks for this version of the file during a build.
+    """
+    key = (str(filename), file_mtime, size)
+    result = this.hash_cache.get(key)
+    if result is None:
+        result = await asyncio.to_thread(hash_file, filename)
+        this.hash_cache[key] = result
+    return result
+
+
+def write_atomic(filename, data):
+    """
+    Writes 'data' to a temp file next to 'filename' and then moves it into
+    place, so a build that gets interrupted can't leave a partial file behind.
+    """
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, filename)
+
+
+def cached_realpath(filename):
+    """Cached version of os.path.realpath(), valid for the duration of a build"""
+    filename = os.fspath(filename)
+    result = this.realpath_cache.get(filename)
+    if result is None:
+        result = os.path.realpath(filename)
+        this.realpath_cache[filename] = result
+    return result
+
+
+def collect_mtimes(filenames):
+    """
+    Stats every file in 'filenames' that isn't already in the mtime cache,
+    batching by directory on Windows. This is blocking, so needs_rerun() runs
+    it on a worker thread. Missing files are left for mtime() to report.
+    """
+    if os.name == "nt":
+        scandir_mtimes(filenames)
+    for filename in filenames:
+        filename = str(filename)
+        if filename not in this.mtime_cache:
+            try:
+                this.mtime_cache[filename] = os.stat(filename).st_mtime
+                this.mtime_calls += 1
+            except OSError:
+                pass
+
+
+def hash_commands(commands):
+    """
+    Returns a hash of a task's command lines as a hex string, or None if any of
+    them are callables whose behavior we can't hash.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for command in commands:
+        if not isinstance(command, str):
+            return None
+        hasher.update(command.encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+# Anything in a command line that needs /bin/sh to interpret it - pipes,
+# redirects, variables, globs, quoting, comments, and so on.
+shell_regex = re.compile(r"[|&;<>`$(){}\[\]*?~!#\\'\"\n]")
+
+
+async def create_subprocess(command):
+    """
+    Starts a command line as an asyncio subprocess. Simple commands are exec'd
+    directly, which saves forking a shell for every task.
+    """
+    if os.name == "posix" and not shell_regex.search(command):
+        argv = shlex.split(command)
+        # 'FOO=bar cmd' is a shell variable assignment, not a program.
+        if argv and "=" not in argv[0]:
+            try:
+                return await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except FileNotFoundError:
+                # Could be a shell builtin, let the shell sort it out.
+                pass
+    return await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def read_stream(stream, echo):
+    """
+    Reads a subprocess output stream to the end in chunks. With 'echo' set we
+    log each complete line as soon as we have it and keep nothing else, so this
+    returns None. Otherwise the whole output is returned as a string.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = []
+    pending = ""
+    while data := await stream.read(65536):
+        text = decoder.decode(data)
+        if echo:
+            pending += text
+            if split := pending.rfind("\n") + 1:
+                log(pending[:split], end="")
+                pending = pending[split:]
+        else:
+            chunks.append(text)
+
+    text = decoder.decode(b"", final=True)
+    if echo:
+        if pending := pending + text:
+            log(pending, end="")
+        return None
+    chunks.append(text)
+    return "".join(chunks)
 
 
 def flatten(elements):
@@ -77,8 +268,16 @@ def flatten(elements):
     if is_atom(elements):
         return [elements]
     result = []
-    for element in elements:
-        result.extend(flatten(element))
+    stack = [iter(elements)]
+    while stack:
+        for element in stack[-1]:
+            if is_atom(element):
+                result.append(element)
+            else:
+                stack.append(iter(element))
+                break
+        else:
+            stack.pop()
     return result
 
 
@@ -167,6 +366,7 @@ def main():
     parser.add_argument("-n", "--dryrun",  default=False,          action="store_true", help="Do not run commands")
     parser.add_argument("-d", "--debug",   default=False,          action="store_true", help="Print debugging information")
     parser.add_argument("-f", "--force",   default=False,          action="store_true", help="Force rebuild of everything")
+    parser.add_argument("--use_hashes",    default=False,          action="store_true", help="Skip tasks whose commands and input contents haven't changed")
     # fmt: on
 
     (flags, unrecognized) = parser.parse_known_args()
@@ -188,6 +388,7 @@ def main():
         dryrun=False,
         debug=False,
         force=False,
+        use_hashes=False,
         desc="{files_in} -> {files_out}",
         build_dir="build",
         task_dir=".",
@@ -230,13 +431,31 @@ async def async_main():
     this.hancho_root = Path.cwd()
     this.hancho_mods = {}
     this.mod_stack = []
+    this.load_resolve_cache = {}
     this.hancho_outs = set()
+    this.active_tasks = set()
     this.tasks_total = 0
     this.tasks_pass = 0
     this.tasks_fail = 0
     this.tasks_skip = 0
     this.task_counter = 0
     this.mtime_calls = 0
+    this.mtime_cache = {}
+    this.depfile_cache = {}
+    this.realpath_cache = {}
+    this.hashes = {}
+    this.hash_cache = {}
+
+    hashes_path = this.hancho_root / ".hancho/hashes.json"
+    if config.use_hashes and hashes_path.exists():
+        # A damaged hash file just means everything gets checked by mtime.
+        try:
+            with open(hashes_path, encoding="utf-8") as file:
+                this.hashes = json.load(file)
+        except (OSError, ValueError):
+            this.hashes = {}
+        if not isinstance(this.hashes, dict):
+            this.hashes = {}
 
     # Load top module(s).
     if not config.filename.exists():
@@ -245,13 +464,19 @@ async def async_main():
     root_filename = config.filename.resolve()
     load_abs(root_filename)
 
-    # Top module(s) loaded. Run all tasks in the queue until we run out.
+    # All tasks share the same set of .hancho files, so we only need to check
+    # their mtimes once.
+    this.max_hancho_mtime = max(mtime(f) for f in this.hancho_mods)
 
-    while True:
-        pending_tasks = asyncio.all_tasks() - {asyncio.current_task()}
-        if not pending_tasks:
-            break
-        await asyncio.wait(pending_tasks)
+    # Top module(s) loaded. Run all tasks in the queue until we run out. Tasks
+    # remove themselves from active_tasks when they finish.
+
+    while this.active_tasks:
+        await asyncio.wait(this.active_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    # Save our content hashes for the next build
+    if config.use_hashes and not config.dryrun:
+        write_atomic(hashes_path, json.dumps(this.hashes).encode("utf-8"))
 
     # Done, print status info if needed
     if config.debug or config.verbose:
@@ -276,6 +501,9 @@ async def async_main():
 # stack of .hancho files that have been loaded.
 
 
+this.hancho_codecache = {}
+
+
 def load(mod_path):
     """
     Searches the loaded Hancho module stack for a module whose directory
@@ -283,8 +511,17 @@ def load(mod_path):
     """
     mod_path = Path(mod_path)
     for parent_mod in reversed(this.mod_stack):
-        abs_path = (Path(parent_mod.__file__).parent / mod_path).resolve()
-        if abs_path.exists():
+        # Module paths resolve the same way for the whole build, so remember
+        # both hits and misses to avoid re-probing the filesystem.
+        key = (str(mod_path), str(parent_mod.__file__))
+        if key in this.load_resolve_cache:
+            abs_path = this.load_resolve_cache[key]
+        else:
+            abs_path = cached_realpath(parent_mod.__file__.parent / mod_path)
+            if not os.path.exists(abs_path):
+                abs_path = None
+            this.load_resolve_cache[key] = abs_path
+        if abs_path is not None:
             return load_abs(abs_path)
     raise FileNotFoundError(f"Could not load module {mod_path}")
 
@@ -297,9 +534,7 @@ def load_abs(abs_path):
     if abs_path in this.hancho_mods:
         return this.hancho_mods[abs_path]
 
-    with open(abs_path, encoding="utf-8") as file:
-        source = file.read()
-        code = compile(source, abs_path, "exec", dont_inherit=True)
+    code = load_code(abs_path)
 
     module = type(sys)(abs_path.stem)
     module.__file__ = abs_path
@@ -322,13 +557,81 @@ def load_abs(abs_path):
     return module
 
 
+def load_code(abs_path):
+    """
+    Compiles a Hancho module, reusing the code object from memory or from
+    .hancho/__pycache__ if the source file hasn't changed.
+    """
+    with open(abs_path, "rb") as file:
+        source = file.read()
+
+    # Caches are validated against the source contents, not mtimes - an edit
+    # that lands in the same second and keeps the size must still be seen.
+    source_hash = hashlib.blake2b(source, digest_size=8).digest()
+    key = (str(abs_path), source_hash)
+    code = this.hancho_codecache.get(key)
+    if code is not None:
+        return code
+
+    # The cached bytecode uses the same header layout as CPython's checked
+    # hash-based .pyc files - magic number, flags, 8-byte source hash - but
+    # with a blake2b hash so it doesn't depend on importlib internals.
+    path_hash = hashlib.blake2b(str(abs_path).encode(), digest_size=8).hexdigest()
+    pyc_path = (
+        this.hancho_root / ".hancho/__pycache__" / f"{abs_path.stem}.{path_hash}.pyc"
+    )
+    header = importlib.util.MAGIC_NUMBER + (0b11).to_bytes(4, "little") + source_hash
+
+    try:
+        with open(pyc_path, "rb") as file:
+            data = file.read()
+        if data[:16] == header:
+            code = marshal.loads(data[16:])
+    except (OSError, EOFError, ValueError, TypeError):
+        code = None
+
+    if code is None:
+        code = compile(source.decode("utf-8"), abs_path, "exec", dont_inherit=True)
+        # Failing to write the cache is not an error.
+        try:
+            write_atomic(pyc_path, header + marshal.dumps(code))
+        except OSError:
+            pass
+
+    this.hancho_codecache[key] = code
+    return code
+
+
 ################################################################################
 # expand + await + flatten
 
-template_regex = re.compile("{[^}]*}")
+template_cache = {}
+
+
+def parse_template(template):
+    """
+    Splits a template string into a list of (literal, code, source) segments,
+    where 'code' is the compiled expression inside a {} block (or None if it
+    doesn't compile) and 'source' is the original {} block text.
+    """
+    segments = []
+    cursor = 0
+    while (start := template.find("{", cursor)) >= 0:
+        end = template.find("}", start + 1)
+        if end < 0:
+            break
+        exp = template[start : end + 1]
+        try:
+            code = compile(exp[1:-1], "<template>", "eval", dont_inherit=True)
+        except (SyntaxError, ValueError):
+            code = None
+        segments.append((template[cursor:start], code, exp))
+        cursor = end + 1
+    segments.append((template[cursor:], None, ""))
+    return segments
 
 
-async def expand_async(rule, template, depth=0):
+async def expand_async(rule, template, depth=0):  # pylint: disable=too-many-branches
     """
     A trivial templating system that replaces {foo} with the value of rule.foo
     and keeps going until it can't replace anything. Templates that evaluate to
@@ -364,20 +667,35 @@ async def expand_async(rule, template, depth=0):
     if not isinstance(template, str):
         template = str(template)
 
-    # Templates get expanded
+    # Plain strings don't need a cache lookup
+    if "{" not in template:
+        return template
+
+    # Tasks remember what their templates expanded to
+    memo = rule.expand_memo
+    if memo is not None and (result := memo.get(template)) is not None:
+        return result
+
+    # Templates get split into segments once and then expanded
+    segments = template_cache.get(template)
+    if segments is None:
+        segments = template_cache[template] = parse_template(template)
+
     result = ""
-    while span := template_regex.search(template):
-        result += template[0 : span.start()]
-        exp = template[span.start() : span.end()]
+    for literal, code, exp in segments:
+        result += literal
+        if code is None:
+            result += exp
+            continue
         try:
-            replacement = eval(exp[1:-1], globals(), rule)  # pylint: disable=eval-used
+            replacement = eval(code, globals(), rule)  # pylint: disable=eval-used
             replacement = await expand_async(rule, replacement, depth + 1)
             result += replacement
         except Exception:  # pylint: disable=broad-except
             result += exp
-        template = template[span.end() :]
-    result += template
 
+    if memo is not None:
+        memo[template] = result
     return result
 
 
@@ -391,15 +709,20 @@ async def flatten_async(rule, elements, depth=0):
         elements = [elements]
 
     result = []
-    for element in elements:
-        if inspect.isfunction(element):
-            result.append(element)
-        elif isinstance(element, list):
-            new_element = await flatten_async(rule, element, depth + 1)
-            result.extend(new_element)
+    stack = [(iter(elements), depth)]
+    while stack:
+        (elements, depth) = stack[-1]
+        for element in elements:
+            if inspect.isfunction(element):
+                result.append(element)
+            elif isinstance(element, list):
+                stack.append((iter(element), depth + 1))
+                break
+            else:
+                new_element = await expand_async(rule, element, depth + 1)
+                result.append(new_element)
         else:
-            new_element = await expand_async(rule, element, depth + 1)
-            result.append(new_element)
+            stack.pop()
 
     return result
 
@@ -428,6 +751,9 @@ class Rule(dict):
     form of prototypal inheritance via Rule.base
     """
 
+    # All fields live in the dict itself, so instances don't need a __dict__.
+    __slots__ = ()
+
     # pylint: disable=too-many-instance-attributes
     def __init__(self, *, base=None, **kwargs):
         super().__init__(self)
@@ -435,15 +761,19 @@ class Rule(dict):
         self.base = config if base is None else base
 
     def __missing__(self, key):
-        if self.base:
-            return self.base[key]
+        # Walk the base chain directly instead of recursing through each base's
+        # __missing__, field lookups are the hottest thing Hancho does.
+        base = dict.get(self, "base")
+        while base:
+            if key in base:
+                return dict.__getitem__(base, key)
+            base = dict.get(base, "base")
         return None
 
-    def __setattr__(self, key, value):
-        self.__setitem__(key, value)
-
-    def __getattr__(self, key):
-        return self.__getitem__(key)
+    # Attribute access maps straight onto the dict's C implementations, which
+    # still call __missing__ for fields we don't have.
+    __setattr__ = dict.__setitem__
+    __getattr__ = dict.__getitem__
 
     def __repr__(self):
         """Turns this rule into a JSON doc for debugging"""
@@ -476,16 +806,19 @@ class Rule(dict):
         task.files_in = files_in
         if files_out is not None:
             task.files_out = files_out
-        task.script_dir = Path.cwd().absolute()
+        task.script_dir = os.getcwd()
         task |= kwargs
         coroutine = task.async_call()
         task.promise = asyncio.create_task(coroutine)
+        this.active_tasks.add(task.promise)
+        task.promise.add_done_callback(this.active_tasks.discard)
         return task.promise
 
     ########################################
 
     async def async_call(self):
         """Entry point for async task stuff."""
+        self.expand_memo = {}
         try:
             result = await self.dispatch()
             return result
@@ -526,55 +859,77 @@ class Rule(dict):
         self.files_in = await flatten_async(self, self.files_in)
         self.files_out = await flatten_async(self, self.files_out)
         self.deps = await flatten_async(self, self.deps)
+        self.expand_memo.clear()
 
         # Prepend directories to filenames and then normalize + absolute them.
-        # If they're already absolute, this does nothing.
-
-        self.build_dir2 = Path(await expand_async(self, self.build_dir))
-        self.build_dir2 = (
-            this.hancho_root
-            / self.build_dir2
-            / self.script_dir.relative_to(this.hancho_root)
+        # If they're already absolute, this does nothing. These are all plain
+        # strings, there are far too many of them per build to make Paths.
+
+        root = str(this.hancho_root)
+        rel_script_dir = relpath(self.script_dir, root)
+        if rel_script_dir == ".." or rel_script_dir.startswith(".." + os.sep):
+            raise ValueError(f"{self.script_dir} is not inside {root}")
+        build_dir = await expand_async(self, self.build_dir)
+        self.build_dir2 = os.path.normpath(
+            os.path.join(root, build_dir, rel_script_dir)
         )
-        self.src_dir = this.hancho_root / self.script_dir.relative_to(this.hancho_root)
+        self.src_dir = os.path.normpath(os.path.join(root, rel_script_dir))
 
         # FIXME - We need to do this with self.task_dir as well
 
-        self.abs_files_in = [self.src_dir / f for f in self.files_in]
-        self.abs_files_out = [self.build_dir2 / f for f in self.files_out]
-        self.abs_deps = [self.src_dir / f for f in self.deps]
+        self.abs_files_in = [join_path(self.src_dir, f) for f in self.files_in]
+        self.abs_files_out = [join_path(self.build_dir2, f) for f in self.files_out]
+        self.abs_deps = [join_path(self.src_dir, f) for f in self.deps]
 
         # Strip hancho_root off the absolute paths to produce root-relative paths
-        self.files_in = [f.relative_to(this.hancho_root) for f in self.abs_files_in]
-        self.files_out = [f.relative_to(this.hancho_root) for f in self.abs_files_out]
-        self.deps = [f.relative_to(this.hancho_root) for f in self.abs_deps]
+        self.files_in = [relpath(f, root) for f in self.abs_files_in]
+        self.files_out = [relpath(f, root) for f in self.abs_files_out]
+        self.deps = [relpath(f, root) for f in self.abs_deps]
+        self.expand_memo.clear()
+
+        # Expand our depfile path now, needs_rerun() reads it later.
+        self.abs_depfile = None
+        if self.depfile:
+            depfile = await expand_async(self, self.depfile)
+            self.abs_depfile = join_path(root, depfile)
 
         # Check for duplicate task outputs
         for file in self.abs_files_out:
-            res_file = file.resolve()
+            res_file = cached_realpath(file)
             if res_file in this.hancho_outs:
                 rel_file = relpath(res_file, config.hancho_root)
                 raise NameError(f"Multiple rules build {rel_file}!")
             this.hancho_outs.add(res_file)
 
+        # With --use_hashes we need our expanded commands to fingerprint the
+        # task. Otherwise don't bother expanding them until we know we'll run.
+        self.command_hash = None
+        if self.use_hashes:
+            commands = await flatten_async(self, self.command)
+            self.command_hash = hash_commands(commands)
+
         # Check if we need a rebuild
         self.reason = await self.needs_rerun()
         if not self.reason:
             this.tasks_skip += 1
             return self.abs_files_out
 
-        # Make sure our output directories exist
-        if not self.dryrun:
-            for file_out in self.abs_files_out:
-                file_out.parent.mkdir(parents=True, exist_ok=True)
+        if not self.use_hashes:
+            commands = await flatten_async(self, self.command)
 
-        # And flatten+expand our command list
-        commands = await flatten_async(self, self.command)
+        # Our saved content hashes are stale now that we're rebuilding
+        old_hashes = {}
+        if self.abs_files_out:
+            old_hashes = this.hashes.pop(self.abs_files_out[0], {})
 
-        # OK, we're ready to start the task. Grab the semaphore before we start
-        # printing status stuff so that it'll end up near the actual task
-        # invocation.
+        # Everything that can await another task's promise has to happen before
+        # we take a job slot, or -j1 deadlocks: we would hold the only slot
+        # while waiting on a task that's queued behind us for it.
         async with self.semaphore:
+            # Make sure our output directories exist
+            if not self.dryrun:
+                for file_out in self.abs_files_out:
+                    os.makedirs(os.path.dirname(file_out), exist_ok=True)
 
             # Deps fulfilled, we are now runnable so grab a task index.
             this.task_counter += 1
@@ -596,17 +951,26 @@ class Rule(dict):
             result = []
             for command in commands:
                 result = await self.run_command(command)
+            self.expand_memo.clear()
 
-        # Task complete, check if it actually updated all the output files
-        if self.files_in and self.files_out and not self.dryrun:
-            if second_reason := await self.needs_rerun():
-                raise ValueError(
-                    f"Task '{desc}' still needs rerun after running!\n"
-                    + f"Reason: {second_reason}"
-                )
+            # Our outputs have (hopefully) changed, so drop their cached mtimes.
+            for file_out in self.abs_files_out:
+                this.mtime_cache.pop(str(file_out), None)
 
-        this.tasks_pass += 1
-        return result
+            # Task complete, check if it actually updated all the output files
+            if self.files_in and self.files_out and not self.dryrun:
+                if second_reason := await self.needs_rerun():
+                    raise ValueError(
+                        f"Task '{desc}' still needs rerun after running!\n"
+                        + f"Reason: {second_reason}"
+                    )
+
+            # Remember the contents of everything this task was built from
+            if self.use_hashes and self.files_in and self.files_out and not self.dryrun:
+                await self.record_hashes(old_hashes)
+
+            this.tasks_pass += 1
+            return result
 
     ########################################
     # Note - We should _not_ be expanding any templates in this step, that
@@ -634,24 +998,15 @@ class Rule(dict):
             raise ValueError(f"Don't know what to do with {command}")
 
         # Create the subprocess via asyncio and then await the result.
+        # Command output gets printed as it arrives, and is only kept around
+        # in self.stdout/self.stderr if it isn't printed.
         with Chdir(self.task_dir):
-            proc = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-        (stdout_data, stderr_data) = await proc.communicate()
-
-        self.stdout = stdout_data.decode()
-        self.stderr = stderr_data.decode()
-        self.returncode = proc.returncode
-
-        # Print command output if needed
-        if not self.quiet and (self.stdout or self.stderr):
-            if self.stderr:
-                log(self.stderr, end="")
-            if self.stdout:
-                log(self.stdout, end="")
+            proc = await create_subprocess(command)
+        (self.stderr, self.stdout, self.returncode) = await asyncio.gather(
+            read_stream(proc.stderr, echo=not self.quiet),
+            read_stream(proc.stdout, echo=not self.quiet),
+            proc.wait(),
+        )
 
         # Task complete, check the task return code
         if self.returncode:
@@ -680,46 +1035,58 @@ class Rule(dict):
 
         # Tasks with missing outputs always run.
         for file_out in files_out:
-            if not file_out.exists():
+            if not os.path.exists(file_out):
                 return f"Rebuilding {self.files_out} because some are missing"
 
+        # Grab all the mtimes we're going to need in one batch, off the event
+        # loop so other tasks can keep going while we wait on the filesystem.
+        uncached = [
+            f
+            for f in files_out + files_in + self.abs_deps
+            if str(f) not in this.mtime_cache
+        ]
+        if uncached:
+            await asyncio.to_thread(collect_mtimes, uncached)
+
+        # With --use_hashes, a task that ran with the same commands and input
+        # contents as last time doesn't need to run again, even if its .hancho
+        # files or input mtimes changed.
+        if self.use_hashes and (record := this.hashes.get(files_out[0])):
+            if self.command_hash is not None and record["command"] != self.command_hash:
+                return f"Rebuilding {self.files_out} because its commands have changed"
+            if await self.fingerprint_matches(record):
+                if self.debug:
+                    log(f"Files {self.files_out} match their last fingerprint")
+                return None
+
         min_out = min(mtime(f) for f in files_out)
 
-        # Check the hancho file(s) that generated the task
-        if max(mtime(f) for f in this.hancho_mods.keys()) >= min_out:
+        # Checks go from cheapest to most expensive. Check the hancho file(s)
+        # that generated the task.
+        if this.max_hancho_mtime >= min_out:
             return f"Rebuilding {self.files_out} because its .hancho files have changed"
 
+        # Check input files.
+        if files_in and max(mtime(f) for f in files_in) >= min_out:
+            if not await self.hashes_match(files_in, min_out):
+                return f"Rebuilding {self.files_out} because an input has changed"
+
         # Check user-specified deps.
-        if self.deps and max(mtime(f) for f in self.deps) >= min_out:
-            return (
-                f"Rebuilding {self.files_out} because a manual dependency has changed"
-            )
+        if self.abs_deps and max(mtime(f) for f in self.abs_deps) >= min_out:
+            if not await self.hashes_match(self.abs_deps, min_out):
+                return (
+                    f"Rebuilding {self.files_out} because a manual dependency "
+                    + "has changed"
+                )
 
         # Check GCC-format depfile, if present.
-        if self.depfile:
-            depfile = Path(await expand_async(self, self.depfile))
-            abs_depfile = (this.hancho_root / depfile).absolute()
-            if abs_depfile.exists():
-                if self.debug:
-                    log(f"Found depfile {abs_depfile}")
-                with open(abs_depfile, encoding="utf-8") as depfile:
-                    deplines = None
-                    if os.name == "nt":
-                        # MSVC /sourceDependencies json depfile
-                        deplines = json.load(depfile)["Data"]["Includes"]
-                    elif os.name == "posix":
-                        # GCC .d depfile
-                        deplines = depfile.read().split()
-                        deplines = [d for d in deplines[1:] if d != "\\"]
-                    if deplines and max(mtime(f) for f in deplines) >= min_out:
-                        return (
-                            f"Rebuilding {self.files_out} because a dependency in "
-                            + f"{abs_depfile} has changed"
-                        )
-
-        # Check input files.
-        if files_in and max(mtime(f) for f in files_in) >= min_out:
-            return f"Rebuilding {self.files_out} because an input has changed"
+        deplines = self.load_depfile()
+        if deplines and max(mtime(f) for f in deplines) >= min_out:
+            if not await self.hashes_match(deplines, min_out):
+                return (
+                    f"Rebuilding {self.files_out} because a dependency in "
+                    + f"{self.abs_depfile} has changed"
+                )
 
         # All checks passed, so we don't need to rebuild this output.
         if self.debug:
@@ -728,6 +1095,133 @@ class Rule(dict):
         # All deps were up-to-date, nothing to do.
         return None
 
+    ########################################
+
+    def load_depfile(self):
+        """Returns the dependencies listed in our GCC/MSVC depfile, if we have one."""
+        if not self.abs_depfile:
+            return []
+
+        try:
+            # Not mtime(), the depfile gets rewritten when its task runs.
+            depfile_mtime = os.stat(self.abs_depfile).st_mtime
+        except FileNotFoundError:
+            return []
+
+        # Depfiles get read both before and after their task runs, only parse
+        # them again if they changed.
+        cached = this.depfile_cache.get(self.abs_depfile)
+        if cached is not None and cached[0] == depfile_mtime:
+            return cached[1]
+
+        if self.debug:
+            log(f"Found depfile {self.abs_depfile}")
+        with open(self.abs_depfile, encoding="utf-8") as depfile:
+            deplines = []
+            if os.name == "nt":
+                # MSVC /sourceDependencies json depfile
+                deplines = json.load(depfile)["Data"]["Includes"]
+            elif os.name == "posix":
+                # GCC .d depfile, streamed a line at a time. The first token is
+                # the target, the rest are dependencies and line continuations.
+                tokens = (token for line in depfile for token in line.split())
+                next(tokens, None)
+                deplines = [d for d in tokens if d != "\\"]
+
+        # Make them absolute so they mean the same thing no matter what the
+        # working directory is when we stat them.
+        deplines = [join_path(this.hancho_root, d) for d in deplines]
+        this.depfile_cache[self.abs_depfile] = (depfile_mtime, deplines)
+        return deplines
+
+    ########################################
+    # Content hashes are stored per task, keyed by the task's first output file
+    # (no two tasks can share an output). Each record holds a hash of the
+    # task's commands, the mtimes of its outputs, and the [mtime, size, hash] of
+    # each of its inputs (by absolute filename) from the last time it ran.
+
+    async def fingerprint_matches(self, record):
+        """
+        Checks if our commands, outputs and input contents all match 'record',
+        in which case the task doesn't need to run no matter what the mtimes say.
+        """
+        if self.command_hash is None or record["command"] != self.command_hash:
+            return False
+
+        outputs = record["outputs"]
+        if len(outputs) != len(self.abs_files_out):
+            return False
+        for file in self.abs_files_out:
+            if outputs.get(file) != mtime(file):
+                return False
+
+        inputs = self.abs_files_in + self.abs_deps + self.load_depfile()
+        if len(record["inputs"]) != len({abspath(f) for f in inputs}):
+            return False
+        for file in inputs:
+            if not await self.input_matches(record, file):
+                return False
+        return True
+
+    async def hashes_match(self, files, min_out):
+        """
+        Checks if all files newer than our outputs still have the same contents
+        they had the last time this task ran.
+        """
+        if not self.use_hashes:
+            return False
+        record = this.hashes.get(self.abs_files_out[0])
+        if record is None:
+            return False
+
+        for file in files:
+            if mtime(file) >= min_out and not await self.input_matches(record, file):
+                return False
+
+        if self.debug:
+            log(f"Files {self.files_out} have newer inputs with unchanged contents")
+        return True
+
+    async def input_matches(self, record, file):
+        """Checks if an input file has the same contents it had in 'record'."""
+        entry = record["inputs"].get(abspath(file))
+        if entry is None:
+            return False
+        file_mtime = mtime(file)
+        size = os.path.getsize(file)
+        if entry[0] == file_mtime and entry[1] == size:
+            return True
+        if entry[1] != size:
+            return False
+        if entry[2] != await cached_hash(file, file_mtime, size):
+            return False
+        # Same contents, new mtime. Save the mtime so we don't have to hash this
+        # file again next time.
+        entry[0] = file_mtime
+        return True
+
+    async def record_hashes(self, old_record):
+        """
+        Saves our fingerprint after a successful run, reusing input hashes from
+        'old_record' for files that haven't been touched.
+        """
+        old_inputs = old_record.get("inputs", {})
+        inputs = {}
+        for file in self.abs_files_in + self.abs_deps + self.load_depfile():
+            filename = abspath(file)
+            file_mtime = mtime(file)
+            size = os.path.getsize(file)
+            entry = old_inputs.get(filename)
+            if entry is None or entry[0] != file_mtime or entry[1] != size:
+                entry = [file_mtime, size, await cached_hash(file, file_mtime, size)]
+            inputs[filename] = entry
+
+        this.hashes[self.abs_files_out[0]] = {
+            "command": self.command_hash,
+            "outputs": {f: mtime(f) for f in self.abs_files_out},
+            "inputs": inputs,
+        }
+
 
 ################################################################################
 
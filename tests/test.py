@@ -57,6 +57,8 @@ class TestHancho(unittest.TestCase):
         """Always wipe the build dir before a test"""
         if path.exists("build"):
             shutil.rmtree("build")
+        if path.exists(".hancho"):
+            shutil.rmtree(".hancho")
 
     def test_should_pass(self):
         """Sanity check"""
@@ -166,6 +168,85 @@ class TestHancho(unittest.TestCase):
         self.assertEqual(mtime1, mtime2)
         self.assertLess(mtime2, mtime3)
 
+    def test_input_touched_with_hashes(self):
+        """Touching a source file without changing it shouldn't rebuild with --use_hashes"""
+        os.system("python3 ../hancho.py --use_hashes --quiet input_changed.hancho")
+        mtime1 = mtime("build/src/test.o")
+
+        Path("src/test.cpp").touch()
+        os.system("python3 ../hancho.py --use_hashes --quiet input_changed.hancho")
+        mtime2 = mtime("build/src/test.o")
+
+        Path("src/test.cpp").touch()
+        os.system("python3 ../hancho.py --quiet input_changed.hancho")
+        mtime3 = mtime("build/src/test.o")
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+
+    def test_hancho_touched_with_hashes(self):
+        """Touching a .hancho file shouldn't rebuild with --use_hashes if the commands match"""
+        os.system("python3 ../hancho.py --use_hashes --quiet input_changed.hancho")
+        mtime1 = mtime("build/src/test.o")
+
+        Path("input_changed.hancho").touch()
+        os.system("python3 ../hancho.py --use_hashes --quiet input_changed.hancho")
+        mtime2 = mtime("build/src/test.o")
+
+        Path("input_changed.hancho").touch()
+        os.system("python3 ../hancho.py --quiet input_changed.hancho")
+        mtime3 = mtime("build/src/test.o")
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+
+    def test_corrupt_hash_file(self):
+        """A damaged .hancho/hashes.json should be ignored, not crash the build"""
+        for contents in ['{"truncated', "[]"]:
+            if path.exists("build"):
+                shutil.rmtree("build")
+            os.makedirs(".hancho", exist_ok=True)
+            with open(".hancho/hashes.json", "w", encoding="utf-8") as file:
+                file.write(contents)
+            self.assertEqual(
+                0,
+                os.system("python3 ../hancho.py --use_hashes --quiet input_changed.hancho"),
+            )
+            self.assertTrue(path.exists("build/src/test.o"))
+
+    def test_command_awaits_promise(self):
+        """A command that awaits another task's promise shouldn't deadlock with -j1"""
+        result = subprocess.run(
+            "python3 ../hancho.py --quiet -j1 command_awaits_promise.hancho".split(),
+            timeout=30,
+            check=False,
+        )
+        self.assertEqual(0, result.returncode)
+        self.assertTrue(path.exists("build/foo_copy.c"))
+
+    def test_hancho_edited_same_size(self):
+        """Editing a .hancho file without changing its size should run the new code"""
+        os.makedirs("build", exist_ok=True)
+        with open("build/version.hancho", "w", encoding="utf-8") as file:
+            file.write('print("VERSION-A")\n')
+        self.assertIn("VERSION-A", run("python3 ../hancho.py build/version.hancho"))
+
+        with open("build/version.hancho", "w", encoding="utf-8") as file:
+            file.write('print("VERSION-B")\n')
+        self.assertIn("VERSION-B", run("python3 ../hancho.py build/version.hancho"))
+
+    def test_command_changed_with_hashes(self):
+        """Changing a task's command should trigger a rebuild with --use_hashes"""
+        hancho = "python3 ../hancho.py --use_hashes --quiet command_changed.hancho"
+        os.system(f"{hancho} --tag=1")
+        mtime1 = mtime("build/foo_copy.c")
+
+        os.system(f"{hancho} --tag=1")
+        mtime2 = mtime("build/foo_copy.c")
+
+        os.system(f"{hancho} --tag=2")
+        mtime3 = mtime("build/foo_copy.c")
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+
     def test_multiple_commands(self):
         """Rules with arrays of commands should run all of them"""
         run_hancho("multiple_commands")